@@ -1,17 +1,23 @@
 import os
-import re
+import time
+import string
+import mimetypes
+import asyncio
 import logging
-import tempfile
-from datetime import datetime
-from pathlib import Path
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from dataclasses import dataclass
+from typing import Optional
 from dotenv import load_dotenv
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler,
     ConversationHandler, ContextTypes, filters
 )
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.http import MediaIoBaseUpload, build_http
 from google.oauth2.credentials import Credentials
 
 # ================= Logging =================
@@ -20,14 +26,29 @@ logger = logging.getLogger(__name__)
 
 # ================= Load .env =================
 load_dotenv()
-TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-SPREADSHEET_ID = os.getenv("GOOGLE_SHEETS_SPREADSHEET_ID")
-SHEET_TAB = os.getenv("GOOGLE_SHEETS_TAB", "Leads")
-GOOGLE_DRIVE_FOLDER_ID = os.getenv("GOOGLE_DRIVE_FOLDER_ID")
 
-if not TELEGRAM_TOKEN:
-    logger.error("❌ TELEGRAM_TOKEN not found in .env!")
-    exit(1)
+@dataclass(frozen=True, slots=True)
+class Config:
+    telegram_token: str
+    spreadsheet_id: str
+    sheet_tab: str
+    drive_folder_id: Optional[str]
+
+REQUIRED_VARS = ("TELEGRAM_TOKEN", "GOOGLE_SHEETS_SPREADSHEET_ID")
+
+def load_config() -> Config:
+    missing = [name for name in REQUIRED_VARS if not os.getenv(name)]
+    if missing:
+        logger.error(f"❌ {', '.join(missing)} not found in .env!")
+        exit(1)
+    return Config(
+        telegram_token=os.environ["TELEGRAM_TOKEN"],
+        spreadsheet_id=os.environ["GOOGLE_SHEETS_SPREADSHEET_ID"],
+        sheet_tab=os.getenv("GOOGLE_SHEETS_TAB", "Leads"),
+        drive_folder_id=os.getenv("GOOGLE_DRIVE_FOLDER_ID"),
+    )
+
+CFG = load_config()
 
 # ================= Google APIs =================
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets","https://www.googleapis.com/auth/drive"]
@@ -35,54 +56,134 @@ SCOPES = ["https://www.googleapis.com/auth/spreadsheets","https://www.googleapis
 # 🔑 Важно: должен лежать рядом с main.py
 creds = Credentials.from_authorized_user_file("token.json", SCOPES)
 
-sheets_service = build("sheets", "v4", credentials=creds)
-drive_service = build("drive", "v3", credentials=creds)
+# Bundled discovery documents are the 2.x default; made explicit here
+sheets_service = build("sheets", "v4", credentials=creds, static_discovery=True, cache_discovery=False)
+drive_service = build("drive", "v3", credentials=creds, static_discovery=True, cache_discovery=False)
 
-def append_to_sheet(values: list):
-    try:
-        body = {"values": [values]}
-        sheets_service.spreadsheets().values().append(
-            spreadsheetId=SPREADSHEET_ID,
-            range=f"{SHEET_TAB}!A1",
-            valueInputOption="USER_ENTERED",
-            insertDataOption="INSERT_ROWS",
-            body=body
-        ).execute()
-        logger.info("✅ Row added to Google Sheets")
-    except Exception as e:
-        logger.error(f"❌ Error writing to Google Sheets: {e}")
+# httplib2.Http is not thread-safe, so each worker thread keeps its own connection
+_thread_local = threading.local()
+
+def thread_http() -> AuthorizedHttp:
+    http = getattr(_thread_local, "http", None)
+    if http is None:
+        http = AuthorizedHttp(creds, http=build_http())
+        _thread_local.http = http
+    return http
+
+def append_to_sheet(rows: list):
+    body = {"values": rows}
+    sheets_service.spreadsheets().values().append(
+        spreadsheetId=CFG.spreadsheet_id,
+        range=f"{CFG.sheet_tab}!A1",
+        valueInputOption="USER_ENTERED",
+        insertDataOption="INSERT_ROWS",
+        body=body
+    ).execute(http=thread_http())
+    logger.info(f"✅ {len(rows)} row(s) added to Google Sheets")
+
+# ================= Sheets buffer =================
+# One append call per SHEET_FLUSH_INTERVAL or SHEET_FLUSH_ROWS; failed rows back off
+# exponentially and are logged and dropped after SHEET_MAX_ATTEMPTS tries.
+SHEET_FLUSH_ROWS = 50
+SHEET_FLUSH_INTERVAL = 2.0
+SHEET_MAX_ATTEMPTS = 6
+SHEET_MAX_BACKOFF = 300.0
+
+row_buffer: list[tuple[list, int]] = []  # (row, failed attempts)
+flush_lock = asyncio.Lock()
+flush_wakeup = asyncio.Event()
+_sheet_retry_at = 0.0
+
+def queue_row(values: list):
+    row_buffer.append((values, 0))
+    if len(row_buffer) >= SHEET_FLUSH_ROWS:
+        flush_wakeup.set()
 
-def upload_to_drive(local_path: str, filename: str, mime_type: str = None) -> str:
-    media = MediaFileUpload(local_path, mimetype=mime_type, resumable=True)
+def log_unwritten_rows(rows: list):
+    for row in rows:
+        logger.error(f"❌ Row not written to Google Sheets: {row}")
+
+async def flush_rows(force: bool = False):
+    global _sheet_retry_at
+    async with flush_lock:
+        if not row_buffer:
+            return
+        if not force and time.monotonic() < _sheet_retry_at:
+            return
+        batch = row_buffer[:]
+        row_buffer.clear()
+        try:
+            await asyncio.to_thread(append_to_sheet, [row for row, _ in batch])
+        except Exception as e:
+            logger.error(f"❌ Error writing to Google Sheets: {e}")
+            batch = [(row, attempts + 1) for row, attempts in batch]
+            log_unwritten_rows([row for row, attempts in batch if attempts >= SHEET_MAX_ATTEMPTS])
+            # Keep the rows that still have attempts left, oldest first
+            retry = [(row, attempts) for row, attempts in batch if attempts < SHEET_MAX_ATTEMPTS]
+            row_buffer[:0] = retry
+            if retry:
+                delay = min(SHEET_FLUSH_INTERVAL * 2 ** retry[0][1], SHEET_MAX_BACKOFF)
+                _sheet_retry_at = time.monotonic() + delay
+            return
+        _sheet_retry_at = 0.0
+
+async def sheet_flusher():
+    while True:
+        try:
+            await asyncio.wait_for(flush_wakeup.wait(), SHEET_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        flush_wakeup.clear()
+        # Shielded so cancelling the flusher on shutdown never drops a write
+        await asyncio.shield(flush_rows())
+
+# Files up to this size go in a single multipart request; only larger
+# ones pay for the extra round trip of a resumable upload session.
+RESUMABLE_UPLOAD_THRESHOLD = 5 * 1024 * 1024
+
+# Dedicated workers for Drive uploads so a burst of CVs uploads in
+# parallel without starving the default executor used by Sheets.
+DRIVE_POOL = ThreadPoolExecutor(max_workers=6, thread_name_prefix="drive")
+
+def upload_to_drive(data: bytes, filename: str, mime_type: str = None) -> str:
+    media = MediaIoBaseUpload(
+        BytesIO(data),
+        # Fall back to the extension when Telegram sends no MIME type
+        mimetype=mime_type or mimetypes.guess_type(filename)[0] or "application/octet-stream",
+        resumable=len(data) > RESUMABLE_UPLOAD_THRESHOLD
+    )
     body = {"name": filename}
-    if GOOGLE_DRIVE_FOLDER_ID:
-        body["parents"] = [GOOGLE_DRIVE_FOLDER_ID]
+    if CFG.drive_folder_id:
+        body["parents"] = [CFG.drive_folder_id]
     try:
         file = drive_service.files().create(
             body=body,
             media_body=media,
             fields="id, webViewLink"
-        ).execute()
+        ).execute(http=thread_http())
         return file.get("webViewLink")
     except Exception as e:
         logger.error(f"❌ Error uploading to Drive: {e}")
         return ""
 
-# ================= Temp dir =================
-DOWNLOAD_ROOT = Path(tempfile.gettempdir()) / "tg_cv_bot"
-DOWNLOAD_ROOT.mkdir(parents=True, exist_ok=True)
+# ================= Filenames =================
+_FILENAME_CHARS = set(string.ascii_letters + string.digits + "_.-")
+_FILENAME_TABLE = str.maketrans({chr(i): chr(i) if chr(i) in _FILENAME_CHARS else "_" for i in range(128)})
+
+def sanitize_filename(name: str) -> str:
+    # Non-ASCII characters become "?" first so the table covers them too
+    return name.encode("ascii", "replace").decode("ascii").translate(_FILENAME_TABLE)
 
 # ================= States =================
 (NAME, EMAIL, PHONE, POSITION, SOURCE, WAITING_FILE) = range(6)
 
 # ================= UI =================
 BTN_SEND = "Send CV"
-def main_menu_kb() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup([[KeyboardButton(BTN_SEND)]], resize_keyboard=True)
+MAIN_MENU_KB = ReplyKeyboardMarkup([[KeyboardButton(BTN_SEND)]], resize_keyboard=True)
 
 # ================= Handlers =================
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("👋 Welcome! Please choose an option.", reply_markup=main_menu_kb())
+    await update.message.reply_text("👋 Welcome! Please choose an option.", reply_markup=MAIN_MENU_KB)
 
 async def apply_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
@@ -122,7 +223,7 @@ async def receive_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.document:
         doc = update.message.document
         file_obj = await context.bot.get_file(doc.file_id)
-        filename = re.sub(r'[^a-zA-Z0-9_.-]', '_', doc.file_name or "cv.pdf")
+        filename = sanitize_filename(doc.file_name or "cv.pdf")
         mime_type = doc.mime_type
     elif update.message.photo:
         photo = update.message.photo[-1]
@@ -133,31 +234,29 @@ async def receive_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⚠️ Please upload your CV as PDF/DOC/DOCX or JPG/PNG.")
         return WAITING_FILE
 
-    local_path = DOWNLOAD_ROOT / filename
     try:
-        await file_obj.download_to_drive(custom_path=str(local_path))
-        if not os.path.exists(local_path):
-            raise FileNotFoundError(f"File not saved: {local_path}")
-        logger.info(f"📥 File saved locally: {local_path}")
+        data = bytes(await file_obj.download_as_bytearray())
+        logger.info(f"📥 File downloaded: {filename} ({len(data)} bytes)")
     except Exception as e:
-        logger.error(f"❌ Error saving file: {e}")
+        logger.error(f"❌ Error downloading file: {e}")
         await update.message.reply_text(f"Error saving your CV: {e}")
         return WAITING_FILE
 
     try:
-        logger.info(f"⬆️ Uploading {local_path} to Google Drive...")
-        drive_link = upload_to_drive(str(local_path), filename, mime_type)
+        logger.info(f"⬆️ Uploading {filename} to Google Drive...")
+        loop = asyncio.get_running_loop()
+        drive_link = await loop.run_in_executor(DRIVE_POOL, upload_to_drive, data, filename, mime_type)
         if drive_link:
             logger.info(f"✅ Uploaded to Drive: {drive_link}")
         else:
             logger.warning("⚠️ File uploaded but no link returned")
     except Exception as e:
         logger.error(f"❌ Error uploading to Drive: {e}")
-        await update.message.reply_text("CV saved locally, but failed to upload to Drive.")
+        await update.message.reply_text("CV received, but failed to upload to Drive.")
         return ConversationHandler.END
 
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    append_to_sheet([
+    now = time.strftime("%Y-%m-%d %H:%M:%S")
+    queue_row([
         now,
         context.user_data.get("name"),
         context.user_data.get("email"),
@@ -170,13 +269,37 @@ async def receive_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text(
         "✅ Thank you! Your CV has been successfully received and uploaded. We will contact you soon.",
-        reply_markup=main_menu_kb()
+        reply_markup=MAIN_MENU_KB
     )
     return ConversationHandler.END
 
 # ================= Main =================
+async def on_startup(app):
+    app.bot_data["sheet_flusher"] = asyncio.create_task(sheet_flusher())
+
+async def on_shutdown(app):
+    flusher = app.bot_data.pop("sheet_flusher", None)
+    if flusher:
+        flusher.cancel()
+        try:
+            await flusher
+        except asyncio.CancelledError:
+            pass
+    await flush_rows(force=True)
+    if row_buffer:
+        # Last chance: the process is exiting, so keep the leads in the logs
+        log_unwritten_rows([row for row, _ in row_buffer])
+        row_buffer.clear()
+    DRIVE_POOL.shutdown(wait=False)
+
 def main():
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    app = (
+        ApplicationBuilder()
+        .token(CFG.telegram_token)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
     conv = ConversationHandler(
         entry_points=[MessageHandler(filters.Regex(r"(?i)^send cv$"), apply_start)],
@@ -186,7 +309,9 @@ def main():
             PHONE: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_position)],
             POSITION: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_source)],
             SOURCE: [MessageHandler(filters.TEXT & ~filters.COMMAND, wait_for_file)],
-            WAITING_FILE: [MessageHandler(filters.Document.ALL | filters.PHOTO, receive_document)],
+            # Non-blocking so uploads don't hold up other users; further updates
+            # from the same user are dropped while their upload is pending
+            WAITING_FILE: [MessageHandler(filters.Document.ALL | filters.PHOTO, receive_document, block=False)],
         },
         fallbacks=[],
     )